@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import io
+import contextlib
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+
+def ar_header(name, size, mode=0o100644):
+    assert len(name) <= 16, f'ar member name too long: "{name}"'
+    return b'%-16s%-12d%-6d%-6d%-8o%-10d`\n' % (
+        name.encode(), 0, 0, 0, mode, size)
+
+
+# ar writer in the layout of dpkg-deb: no symbol table, short names
+# without trailing slash, zeroed mtime and owners.
+class ArWriter(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.fileobj.write(AR_MAGIC)
+
+    def add(self, name, data):
+        self.fileobj.write(ar_header(name, len(data)))
+        self.fileobj.write(data)
+        self.pad(len(data))
+
+    # stream a member of unknown size, its header is patched afterwards,
+    # so the output must be seekable.
+    @contextlib.contextmanager
+    def member(self, name):
+        start = self.fileobj.tell()
+        self.fileobj.write(ar_header(name, 0))
+        yield self.fileobj
+        end = self.fileobj.tell()
+        size = end - start - AR_HEADER_SIZE
+        self.fileobj.seek(start)
+        self.fileobj.write(ar_header(name, size))
+        self.fileobj.seek(end)
+        self.pad(size)
+
+    def pad(self, size):
+        if size % 2:
+            self.fileobj.write(b'\n')
+
+
+class ArMember(io.RawIOBase):
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remain = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remain)
+        if n <= 0:
+            return 0
+        data = self.fileobj.read(n)
+        if not data:
+            raise EOFError('truncated ar member')
+        b[:len(data)] = data
+        self.remain -= len(data)
+        return len(data)
+
+    def skip(self):
+        while self.remain:
+            self.read(min(self.remain, 1 << 20))
+
+
+# iterate members of an ar stream, each member is only readable until the
+# next one is requested.
+def read_ar(fileobj):
+    if fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError('not an ar archive')
+
+    while header := fileobj.read(AR_HEADER_SIZE):
+        if len(header) != AR_HEADER_SIZE or header[58:] != b'`\n':
+            raise ValueError('bad ar member header')
+        name = header[:16].decode().rstrip().rstrip('/')
+        size = int(header[48:58])
+        member = ArMember(fileobj, size)
+        yield name, io.BufferedReader(member, 1 << 16)
+        member.skip()
+        if size % 2:
+            fileobj.read(1)
@@ -7,12 +7,20 @@ import fire
 import yaml
 import utils
 import shutil
+import difflib
 import tomllib
 import subprocess
 from loguru import logger
 from pathlib import Path
+from functools import partial
 from sysroot import Sysroot
 from package import Package
+from ledger import Ledger
+from ninjalog import NinjaLog
+import jobserver
+from jobserver import Supervisor
+from ccache import CompilerCache
+from scheduler import Scheduler
 
 
 class GitProgress(git.RemoteProgress):
@@ -37,11 +45,25 @@ class Build:
         root = cfg['flutter'].get('path')
         arch = cfg['build'].get('arch')
         mode = cfg['build'].get('runtime')
+        jobs = cfg['build'].get('jobs')
+        parallel = cfg['build'].get('parallel')
+        load = cfg['build'].get('load')
+        min_free = cfg['build'].get('min_free')
+        launcher = cfg['build'].get('launcher')
+        launcher_dir = cfg['build'].get('launcher_dir')
+        launcher_size = cfg['build'].get('launcher_size')
         gclient = cfg['build'].get('gclient')
         sysroot = cfg['sysroot']
         syspath = sysroot.pop('path')
+        if cache := sysroot.get('cache'):
+            sysroot['cache'] = path/cache
+        if (snapshot := sysroot.get('snapshot')) and '://' not in snapshot:
+            sysroot['snapshot'] = str(path/snapshot)
+        ledger = cfg['build'].get('ledger')
         package = cfg['package'].get('conf')
         release = cfg['package'].get('path')
+        split = cfg['package'].get('split', False)
+        shared = cfg['build'].get('shared')
         patches = cfg.get('patch')
 
         if not ndk:
@@ -56,23 +78,40 @@ class Build:
         # TODO: detect host
         self.host = 'linux-x86_64'
         self.repo = repo or 'https://github.com/flutter/flutter'
-        self.arch = arch or 'arm64'
-        self.mode = mode or 'debug'
+        self.arch = arch or ['arm64']
+        self.mode = mode or ['debug']
+        self.jobs = jobs
+        self.parallel = parallel or 1
+        self.load = load
+        # MiB
+        self.min_free = None if min_free is None else min_free << 20
         self.sysroot = Sysroot(path=path/syspath, **sysroot)
         self.root = path/root
         self.gclient = path/gclient
         self.release = path/release
+        self.ledger = path/(ledger or '.stages.json')
+        self.split = split
+        self.shared = shared
+        self.ccache = None
+        if launcher:
+            self.ccache = CompilerCache(
+                launcher, path/(launcher_dir or '.cache/compiler'), launcher_size)
         self.toolchain = Path(ndk, f'toolchains/llvm/prebuilt/{self.host}')
 
+        if isinstance(self.arch, str):
+            self.arch = [self.arch]
+        if isinstance(self.mode, str):
+            self.mode = [self.mode]
+        if self.shared and self.shared not in self.mode:
+            raise ValueError(f'shared runtime is not built: "{self.shared}"')
         if not self.release.parent.is_dir():
             raise ValueError(f'bad release path: "{release}"')
 
         with open(path/package, 'rb') as f:
             self.package = yaml.safe_load(f)
 
+        self.patches = {}
         if isinstance(patches, dict):
-            self.patches = {}
-
             def patch(key):
                 return lambda: self.patch(**self.patches[key])
 
@@ -121,17 +160,16 @@ class Build:
         repo = git.Repo(path)
         repo.git.apply([file])
 
-    def configure(
+    def gn(
         self,
         arch: str,
         mode: str,
-        api: int = 26,
-        root: str = None,
+        api: int = None,
         sysroot: str = None,
         toolchain: str = None,
     ):
-        root = root or self.root
-        sysroot = os.path.abspath(sysroot or self.sysroot.path)
+        api = api or self.api
+        sysroot = os.path.abspath(sysroot or self.sysroot.target(arch))
         toolchain = os.path.abspath(toolchain or self.toolchain)
         cmd = [
             'vpython3',
@@ -163,12 +201,50 @@ class Build:
             '--gn-args', f'is_termux_host={utils.__TERMUX__}',
             '--gn-args', f'termux_api_level={api}',
         ]
+        if self.ccache:
+            cmd += ['--gn-args', 'use_ccache=true']
+        return cmd
+
+    def configure(
+        self,
+        arch: str,
+        mode: str,
+        api: int = None,
+        root: str = None,
+        sysroot: str = None,
+        toolchain: str = None,
+        force: bool = False,
+    ):
+        root = root or self.root
+        cmd = self.gn(arch, mode, api, sysroot, toolchain)
+        out = Path(utils.target_output(root, arch, mode))
+
+        # regenerating build.ninja with the same args only costs ninja
+        # state, ninja itself reruns gn when a BUILD.gn changes.
+        if not force and (out/'build.ninja').is_file() and (out/'args.gn').is_file():
+            try:
+                want = utils.flutter_gn_args(root, cmd[2:])
+            except (Exception, SystemExit) as e:
+                logger.warning(f'failed to evaluate gn args: {e!r}')
+            else:
+                with open(out/'args.gn') as f:
+                    have = utils.parse_gn_args(f)
+                if want == have:
+                    logger.info(f'{out.name} gn args unchanged, skip.')
+                    return
+                diff = difflib.unified_diff(
+                    [f'{k} = {v}' for k, v in sorted(have.items())],
+                    [f'{k} = {v}' for k, v in sorted(want.items())],
+                    'args.gn', 'expected', lineterm='')
+                logger.info('\n'.join(['gn args changed:', *diff]))
+
         subprocess.run(cmd, cwd=root, check=True, stdout=True, stderr=True)
 
     def build(self, arch: str, mode: str, root: str = None, jobs: int = None):
         root = root or self.root
+        out = utils.target_output(root, arch, mode)
         cmd = [
-            'ninja', '-C', utils.target_output(root, arch, mode),
+            'ninja', '-C', out,
             'flutter',
             # disable zip_archives
             # 'flutter/build/archives:artifacts',
@@ -177,17 +253,54 @@ class Build:
             # 'flutter/shell/platform/linux:flutter_gtk',
             # 'flutter/tools/font_subset',
         ]
-        if jobs:
-            cmd.append(f'-j{jobs}')
-        subprocess.run(cmd, check=True, stdout=True, stderr=True)
+        if self.shared and mode != self.shared:
+            cmd[3:] = self.targets(arch, mode, root) or cmd[3:]
+        env = None
+        if self.ccache:
+            env = self.ccache.env()
+            stats = self.ccache.stats()
+        with NinjaLog(Path(out)/'.ninja_log').watch(out):
+            Supervisor(cmd, jobs, self.load, self.min_free, env)()
+        if self.ccache:
+            self.ccache.report(stats)
+
+    # paths the package takes from the output of `mode`.
+    def requires(self, arch: str, mode: str, root: str = None):
+        root = root or self.root
+        out = utils.target_output(root, arch, mode)
+        pkg = Package(root=root, arch=arch, shared=self.shared, **self.package)
+        return sorted(set(pkg.requires(out)))
+
+    # ninja targets of `mode` that the package takes from its output, mode
+    # independent ones are only built in the `shared` mode.
+    def targets(self, arch: str, mode: str, root: str = None):
+        root = root or self.root
+        out = utils.target_output(root, arch, mode)
+        requires = self.requires(arch, mode, root)
+
+        cmd = ['ninja', '-C', out, '-t', 'targets', 'all']
+        proc = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        known = [it.rsplit(': ', 1)[0] for it in proc.stdout.splitlines()]
+
+        targets = set()
+        for it in requires:
+            found = [t for t in known if t == it or t.startswith(f'{it}/')]
+            if not found:
+                logger.warning(f'{out}: no ninja target for "{it}"')
+            targets.update(found)
+        logger.info(f'{Path(out).name}: {len(targets)} targets for {requires}')
+        return sorted(targets)
 
     def debuild(self, arch: str, output: str = None, root: str = None, **conf):
         conf = conf or self.package
         root = root or self.root
         output = output or self.output(arch)
 
-        pkg = Package(root=root, arch=arch, **conf)
-        pkg.debuild(output=output)
+        pkg = Package(root=root, arch=arch, shared=self.shared, **conf)
+        if self.split:
+            pkg.debuild_parts(output=Path(output).parent)
+        else:
+            pkg.debuild(output=output)
 
     def output(self, arch: str):
         if self.release.is_dir():
@@ -196,18 +309,64 @@ class Build:
         else:
             return self.release
 
-    # TODO: check gclient and ninja existence
-    def __call__(self):
-        self.config()
-        self.clone()
-        self.sync()
+    def schedule(self, force=None):
+        ledger = Ledger(self.ledger, force)
+        patches = [it['file'] for it in self.patches.values()]
+
+        # split the job budget between concurrent ninja, let ninja decide
+        # when there is only one of them and no budget is given.
+        if self.jobs or self.parallel > 1:
+            jobs = max(1, (self.jobs or os.cpu_count()) // self.parallel)
+        else:
+            jobs = None
+
+        sched = Scheduler(abort=jobserver.stop_all, ninja=self.parallel)
+        clone = sched.add('clone', partial(
+            ledger, 'clone', self.clone,
+            inputs=[self.repo, self.tag],
+            outputs=[self.root]))
+        sync = sched.add('sync', partial(
+            ledger, 'sync', self.sync,
+            inputs=[self.gclient],
+            deps=[clone],
+            outputs=[self.root/'engine/src/flutter']), clone)
 
+        sysroot = sched.add('sysroot', partial(self.sysroot, *self.arch))
         for arch in self.arch:
-            self.sysroot(arch=arch)
+            builds = []
             for mode in self.mode:
-                self.configure(arch=arch, mode=mode)
-                self.build(arch=arch, mode=mode)
-            self.debuild(arch=arch, output=self.output(arch))
+                # targets of the other modes come from package.yaml, known
+                # once the mode is configured
+                targets = None
+                if self.shared not in (None, mode):
+                    targets = partial(self.requires, arch, mode)
+                out = Path(utils.target_output(self.root, arch, mode))
+                key = f'configure:{arch}:{mode}'
+                conf = sched.add(key, partial(
+                    ledger, key,
+                    partial(self.configure, arch=arch, mode=mode, force=ledger.forced(key)),
+                    inputs=[self.gn(arch, mode)],
+                    deps=[sync],
+                    outputs=[out/'build.ninja']), sync, sysroot)
+                builds.append(sched.add(f'build:{arch}:{mode}', partial(
+                    ledger, f'build:{arch}:{mode}',
+                    partial(self.build, arch=arch, mode=mode, jobs=jobs),
+                    inputs=[*patches, self.sysroot.manifest(arch), targets],
+                    deps=[conf],
+                    outputs=[out]), conf, pool='ninja'))
+            output = self.output(arch)
+            sched.add(f'debuild:{arch}', partial(
+                ledger, f'debuild:{arch}',
+                partial(self.debuild, arch=arch, output=output),
+                inputs=[self.package],
+                deps=builds,
+                outputs=[output]), *builds)
+        return sched
+
+    # TODO: check gclient and ninja existence
+    def __call__(self, force=None):
+        self.config()
+        self.schedule(force)()
 
 
 if __name__ == '__main__':
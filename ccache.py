@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import subprocess
+from loguru import logger
+from pathlib import Path
+
+
+# a ccache compatible compiler launcher. with `use_ccache` the engine
+# toolchains prefix every compile with `ccache`, a shim put in front of PATH
+# forwards it to the configured launcher.
+class CompilerCache(object):
+    def __init__(self, launcher: str, path: str, size: int = None):
+        self.name = Path(launcher).name
+        assert self.name in ('ccache', 'sccache'), f'unknown compiler launcher: "{launcher}"'
+        self.launcher = shutil.which(launcher)
+        assert self.launcher, f'compiler launcher not found: "{launcher}"'
+        self.path = Path(path).expanduser().resolve()
+        # MiB
+        self.size = size
+
+    def env(self):
+        shim = self.path/'bin'/'ccache'
+        script = f'#!/bin/sh\nexec "{self.launcher}" "$@"\n'
+        if not shim.is_file() or shim.read_text() != script:
+            shim.parent.mkdir(parents=True, exist_ok=True)
+            shim.write_text(script)
+            shim.chmod(0o755)
+
+        env = dict(os.environ)
+        env['PATH'] = f'{shim.parent}{os.pathsep}{env.get("PATH", "")}'
+        if self.name == 'ccache':
+            env['CCACHE_DIR'] = str(self.path/'ccache')
+            if self.size:
+                env['CCACHE_MAXSIZE'] = f'{self.size}M'
+        else:
+            env['SCCACHE_DIR'] = str(self.path/'sccache')
+            if self.size:
+                env['SCCACHE_CACHE_SIZE'] = f'{self.size}M'
+        return env
+
+    # (hits, misses) since the cache was created.
+    def stats(self):
+        if self.name == 'ccache':
+            cmd = [self.launcher, '--print-stats']
+        else:
+            cmd = [self.launcher, '--show-stats', '--stats-format=json']
+        proc = subprocess.run(cmd, env=self.env(), capture_output=True, text=True)
+        if proc.returncode != 0:
+            logger.warning(f'{self.name} stats unavailable: {proc.stderr.strip()}')
+            return 0, 0
+
+        if self.name == 'ccache':
+            stats = dict(
+                line.split('\t', 1) for line in proc.stdout.splitlines() if '\t' in line)
+            hits = sum(int(stats.get(it, 0)) for it in (
+                'direct_cache_hit', 'preprocessed_cache_hit'))
+            return hits, int(stats.get('cache_miss', 0))
+
+        stats = json.loads(proc.stdout)['stats']
+        return (
+            sum(stats['cache_hits']['counts'].values()),
+            sum(stats['cache_misses']['counts'].values()))
+
+    def report(self, before):
+        hits, misses = (b - a for a, b in zip(before, self.stats()))
+        if total := hits + misses:
+            logger.info(
+                f'✓ 编译缓存 {self.name} {hits}/{total} hits ({hits / total:.1%})')
+        return hits, misses
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import gzip
+import lzma
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = b'YZ'
+XZ_DICT_SIZE = [18, 20, 21, 22, 22, 23, 23, 24, 25, 26]
+# MiB of encoder state by preset, from xz(1)
+XZ_ENC_MEM = [3, 9, 17, 32, 48, 94, 94, 186, 370, 674]
+# fraction of the physical memory the threads may use, as `xz -T`
+XZ_MEMLIMIT = 0.25
+SUFFIX = {'xz': '.xz', 'zstd': '.zst', 'gzip': '.gz', 'none': ''}
+FORMAT = {'.xz': 'xz', '.zst': 'zstd', '.gz': 'gzip', '.tar': 'none'}
+
+
+def _encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        n |= (byte & 0x7f) << shift
+        pos += 1
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _xz_block(data, preset, check):
+    # compress as a single-block stream, then cut the block out of it and
+    # read its sizes back from the stream index.
+    xz = lzma.compress(data, format=lzma.FORMAT_XZ, check=check, preset=preset)
+    backward, = struct.unpack_from('<I', xz, len(xz) - 8)
+    index = len(xz) - 12 - (backward + 1) * 4
+    count, pos = _decode_varint(xz, index + 1)
+    assert xz[index] == 0 and count == 1
+    unpadded, pos = _decode_varint(xz, pos)
+    size, pos = _decode_varint(xz, pos)
+    return xz[12:index], unpadded, size
+
+
+# threads whose encoders, input and output blocks fit into XZ_MEMLIMIT of
+# the physical memory, at least one.
+def xz_threads(threads, preset, block):
+    total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    each = (XZ_ENC_MEM[preset & 0xf] << 20) + 2 * block
+    return max(1, min(threads, int(total * XZ_MEMLIMIT) // each))
+
+
+# xz writer compressing fixed-size blocks concurrently into one xz stream.
+# the output only depends on preset and block size, not on thread count.
+class XZWriter(io.RawIOBase):
+    def __init__(self, fileobj, preset=6, threads=None, block=None):
+        self.fileobj = fileobj
+        self.preset = preset
+        self.check = lzma.CHECK_CRC64
+        self.block = block or 3 << XZ_DICT_SIZE[preset & 0xf]
+        self.threads = xz_threads(threads or os.cpu_count(), preset, self.block)
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.records = []
+        self.buffer = bytearray()
+        self.offset = 0
+        self.flags = struct.pack('<BB', 0, self.check)
+
+        fileobj.write(XZ_MAGIC)
+        fileobj.write(self.flags)
+        fileobj.write(struct.pack('<I', zlib.crc32(self.flags)))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def write(self, b):
+        self.buffer += b
+        self.offset += len(b)
+        while len(self.buffer) >= self.block:
+            self._submit(bytes(self.buffer[:self.block]))
+            del self.buffer[:self.block]
+        return len(b)
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(
+            _xz_block, data, self.preset, self.check))
+        while len(self.pending) > self.threads:
+            self._drain()
+
+    def _drain(self):
+        block, unpadded, size = self.pending.popleft().result()
+        self.fileobj.write(block)
+        self.records.append((unpadded, size))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._drain()
+        finally:
+            self.executor.shutdown()
+
+        index = bytearray(b'\0')
+        index += _encode_varint(len(self.records))
+        for unpadded, size in self.records:
+            index += _encode_varint(unpadded)
+            index += _encode_varint(size)
+        index += bytes(-len(index) % 4)
+        index += struct.pack('<I', zlib.crc32(index))
+        self.fileobj.write(index)
+
+        footer = struct.pack('<I', len(index) // 4 - 1) + self.flags
+        self.fileobj.write(struct.pack('<I', zlib.crc32(footer)))
+        self.fileobj.write(footer)
+        self.fileobj.write(XZ_FOOTER_MAGIC)
+        super().close()
+
+
+class PlainWriter(io.RawIOBase):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def write(self, b):
+        self.fileobj.write(b)
+        self.offset += len(b)
+        return len(b)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compression requires "zstandard"')
+    return zstandard
+
+
+def format_of(name):
+    suffix = os.path.splitext(name)[1]
+    if suffix not in FORMAT:
+        raise ValueError(f'unknown compression: "{name}"')
+    return FORMAT[suffix]
+
+
+def reader(fileobj, format='xz'):
+    if format == 'xz':
+        return lzma.LZMAFile(fileobj)
+    if format == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if format == 'zstd':
+        dctx = _zstandard().ZstdDecompressor()
+        return dctx.stream_reader(fileobj, closefd=False)
+    if format == 'none':
+        return fileobj
+    raise ValueError(f'unknown compression: "{format}"')
+
+
+def writer(fileobj, format='xz', level=None, threads=None, block=None):
+    if format == 'xz':
+        return XZWriter(fileobj, 6 if level is None else level, threads, block)
+    if format == 'gzip':
+        level = 9 if level is None else level
+        return gzip.GzipFile(
+            filename='', fileobj=fileobj, mode='wb', compresslevel=level, mtime=0)
+    if format == 'zstd':
+        level = 3 if level is None else level
+        cctx = _zstandard().ZstdCompressor(level=level, threads=threads or -1)
+        return cctx.stream_writer(fileobj, closefd=False)
+    if format == 'none':
+        return PlainWriter(fileobj)
+    raise ValueError(f'unknown compression: "{format}"')
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import shutil
+import signal
+import tempfile
+import functools
+import threading
+import subprocess
+from loguru import logger
+
+JOBSERVER_INTERVAL = 2
+JOBSERVER_MIN_FREE = 0.05
+JOBSERVER_STOP_TIMEOUT = 30
+JOBSERVER_RECOVER = 300
+
+
+def meminfo():
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) << 10
+    return info
+
+
+def oom_kills():
+    try:
+        with open('/proc/vmstat') as f:
+            for line in f:
+                if line.startswith('oom_kill '):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return 0
+
+
+_live = set()
+_lock = threading.Lock()
+
+
+# stop every running supervisor, ninja runs in its own session so an
+# interrupt of the build does not reach it.
+def stop_all():
+    with _lock:
+        live = list(_live)
+    for it in live:
+        it.abort()
+
+
+# the (major, minor) version of ninja, () when it can not be run.
+@functools.cache
+def ninja_version(ninja):
+    try:
+        out = subprocess.run([ninja, '--version'], capture_output=True, text=True).stdout
+    except OSError:
+        return ()
+    return tuple(int(it) for it in re.findall(r'\d+', out)[:2])
+
+
+# a GNU make jobserver fifo, a client takes a token for every job but its
+# first one, so tokens added while it runs widen it without a restart.
+class Tokens(object):
+    def __init__(self, jobs):
+        self.dir = tempfile.mkdtemp(prefix='jobserver-')
+        self.path = os.path.join(self.dir, 'fifo')
+        os.mkfifo(self.path)
+        # read-write, so writes neither block nor fail without readers
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        self.add(jobs - 1)
+
+    def add(self, count):
+        os.write(self.fd, b'+' * count)
+
+    def env(self, env, jobs):
+        env = dict(env or os.environ)
+        env['MAKEFLAGS'] = f'-j{jobs} --jobserver-auth=fifo:{self.path}'
+        return env
+
+    def close(self):
+        os.close(self.fd)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+# run ninja with a job count adapted to memory: ninja is stopped and
+# restarted with half of the jobs when available memory drops under
+# `min_free` bytes or one of its commands gets OOM-killed. ninja 1.13 and
+# later get their jobs from a jobserver fifo, which is given twice the
+# tokens, up to the initial count, once memory stayed over twice
+# `min_free` for JOBSERVER_RECOVER seconds, without interrupting running
+# edges. older ninja keep the reduced -j. `-l` holds back new jobs when the
+# cpu is overloaded. finished edges are kept by ninja, so a restart only
+# repeats the interrupted ones.
+class Supervisor(object):
+    def __init__(
+        self,
+        cmd,
+        jobs=None,
+        load=None,
+        min_free=None,
+        env=None,
+        interval=JOBSERVER_INTERVAL,
+        recover=JOBSERVER_RECOVER,
+    ):
+        self.cmd = cmd
+        self.jobs = self.max_jobs = jobs or os.cpu_count() + 2
+        self.load = load or os.cpu_count()
+        self.min_free = min_free
+        self.env = env
+        self.interval = interval
+        self.recover = recover
+        self.fifo = ninja_version(cmd[0]) >= (1, 13)
+        self.proc = None
+        self.aborted = False
+
+    def stop(self, proc):
+        if proc.poll() is not None:
+            return
+        os.killpg(proc.pid, signal.SIGINT)
+        try:
+            proc.wait(JOBSERVER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+    def abort(self):
+        self.aborted = True
+        if proc := self.proc:
+            self.stop(proc)
+
+    # returns the exit code and why ninja was stopped, if it was.
+    def run(self, min_free):
+        # an explicit -j makes ninja ignore the jobserver
+        if tokens := self.fifo and Tokens(self.jobs):
+            cmd = [*self.cmd, f'-l{self.load}']
+            env = tokens.env(self.env, self.jobs)
+        else:
+            cmd = [*self.cmd, f'-j{self.jobs}', f'-l{self.load}']
+            env = self.env
+        logger.debug(' '.join(cmd))
+        try:
+            self.proc = proc = subprocess.Popen(cmd, env=env, start_new_session=True)
+            clear = time.monotonic()
+            try:
+                while True:
+                    try:
+                        return proc.wait(self.interval), None
+                    except subprocess.TimeoutExpired:
+                        pass
+                    free = meminfo()['MemAvailable']
+                    if self.jobs > 1 and free < min_free:
+                        self.stop(proc)
+                        return proc.returncode, 'low memory'
+                    if not tokens or self.jobs >= self.max_jobs or free < 2 * min_free:
+                        clear = time.monotonic()
+                    elif time.monotonic() - clear >= self.recover:
+                        jobs = min(self.max_jobs, self.jobs * 2)
+                        tokens.add(jobs - self.jobs)
+                        self.jobs = jobs
+                        clear = time.monotonic()
+                        logger.info(f'memory recovered, ninja runs -j{jobs}')
+            except BaseException:
+                self.stop(proc)
+                raise
+        finally:
+            self.proc = None
+            if tokens:
+                tokens.close()
+
+    def __call__(self):
+        if not os.path.isfile('/proc/meminfo'):
+            cmd = [*self.cmd, f'-j{self.jobs}', f'-l{self.load}']
+            subprocess.run(cmd, env=self.env, check=True, stdout=True, stderr=True)
+            return
+
+        min_free = self.min_free
+        if min_free is None:
+            min_free = int(meminfo()['MemTotal'] * JOBSERVER_MIN_FREE)
+
+        with _lock:
+            _live.add(self)
+        try:
+            while not self.aborted:
+                kills = oom_kills()
+                code, reason = self.run(min_free)
+                if code == 0:
+                    return
+                if self.aborted:
+                    break
+                if reason is None and oom_kills() != kills:
+                    reason = 'OOM killed'
+                if reason is None or self.jobs == 1:
+                    raise subprocess.CalledProcessError(code, self.cmd)
+
+                self.jobs = max(1, self.jobs // 2)
+                logger.warning(f'{reason}, restart ninja with -j{self.jobs}')
+            raise subprocess.CalledProcessError(-signal.SIGINT, self.cmd)
+        finally:
+            with _lock:
+                _live.discard(self)
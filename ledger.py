@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import threading
+from loguru import logger
+from pathlib import Path
+
+
+def hash_file(path, algo='sha256'):
+    hash = hashlib.new(algo)
+    with open(path, 'rb') as f:
+        while s := f.read(1 << 20):
+            hash.update(s)
+    return hash.hexdigest()
+
+
+# callable inputs are evaluated here, when the stage is about to run.
+def fingerprint(*inputs):
+    hash = hashlib.sha256()
+    for it in inputs:
+        if callable(it):
+            it = it()
+        if isinstance(it, Path):
+            it = hash_file(it) if it.is_file() else str(it)
+        hash.update(json.dumps(it, sort_keys=True, default=str).encode())
+        hash.update(b'\0')
+    return hash.hexdigest()
+
+
+class Ledger(object):
+    def __init__(self, path, force=None):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.data = {}
+
+        if isinstance(force, str):
+            force = [force]
+        self.force = set(force or [])
+
+        if self.path.is_file():
+            with open(self.path) as f:
+                self.data = json.load(f)
+
+    def forced(self, key):
+        stage = key.split(':', 1)[0]
+        return 'all' in self.force or stage in self.force
+
+    def fresh(self, key, fp, outputs):
+        if self.forced(key):
+            return False
+        if (entry := self.data.get(key)) is None:
+            return False
+        if entry['fingerprint'] != fp:
+            return False
+        return all(Path(it).exists() for it in outputs)
+
+    # run a stage unless its inputs, upstream stages and outputs are the
+    # same as the last successful run.
+    def __call__(self, key, func, inputs=(), deps=(), outputs=()):
+        with self.lock:
+            upstream = [self.data.get(it) for it in deps]
+        fp = fingerprint(*inputs, upstream)
+
+        if self.fresh(key, fp, outputs):
+            logger.info(f'{key} is up to date, skip.')
+            return
+
+        func()
+
+        with self.lock:
+            self.data[key] = {'fingerprint': fp, 'time': time.time()}
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
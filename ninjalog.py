@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import json
+import bisect
+import threading
+import contextlib
+from loguru import logger
+from pathlib import Path
+
+NINJALOG_TOP = 20
+NINJALOG_BUCKETS = 200
+NINJALOG_INTERVAL = 60
+NINJALOG_REPORT = 'ninja_report.json'
+NINJALOG_TRACE = 'ninja_trace.json'
+
+
+class Edge(object):
+    def __init__(self, start, end, hash):
+        self.start = start
+        self.end = end
+        self.hash = hash
+        self.outputs = []
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def name(self):
+        return self.outputs[0] if len(self.outputs) == 1 else str(self.outputs)
+
+
+# .ninja_log read incrementally, entries with the same start, end and
+# command hash are one edge, and a new run starts whenever the clock goes
+# back.
+class NinjaLog(object):
+    def __init__(self, path):
+        self.path = Path(path)
+        self.inode = None
+        self.offset = 0
+        self.last = 0
+        self.runs = []
+        self.known = {}
+        self.lock = threading.Lock()
+
+    def update(self):
+        if not self.path.is_file():
+            return 0
+        stat = self.path.stat()
+        with self.lock:
+            # recompacted by ninja
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.inode = stat.st_ino
+                self.offset = self.last = 0
+                self.runs = []
+                self.known = {}
+
+            count = 0
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                while (line := f.readline()).endswith(b'\n'):
+                    self.offset += len(line)
+                    count += self._parse(line.decode(errors='replace'))
+            return count
+
+    def _parse(self, line):
+        if line.startswith('#'):
+            return 0
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 5:
+            return 0
+        start, end, output, hash = int(fields[0]), int(fields[1]), fields[3], fields[4]
+
+        if not self.runs or end < self.last:
+            if self.runs:
+                for it in self.runs[-1].values():
+                    self.known.update((out, it.hash) for out in it.outputs)
+            self.runs.append({})
+        self.last = end
+
+        run = self.runs[-1]
+        if (edge := run.get((start, end, hash))) is None:
+            edge = run[(start, end, hash)] = Edge(start, end, hash)
+        edge.outputs.append(output)
+        return 1
+
+    # the next entry starts a new run even if the clock did not go back,
+    # returns its index.
+    def mark(self):
+        with self.lock:
+            self.last = float('inf')
+            return len(self.runs)
+
+    # edges of the runs from `first` on, each run is shifted to start when
+    # the previous one ended.
+    def edges(self, first=-1):
+        with self.lock:
+            runs = self.runs[first:] if self.runs else []
+        edges = []
+        offset = 0
+        for run in runs:
+            for it in run.values():
+                edge = Edge(it.start + offset, it.end + offset, it.hash)
+                edge.outputs = it.outputs
+                edges.append(edge)
+            offset = max((it.end for it in edges), default=offset)
+        return edges
+
+    def report(self, first=-1, top=NINJALOG_TOP):
+        edges = sorted(self.edges(first), key=lambda it: it.end)
+        if not edges:
+            return None
+
+        begin = min(it.start for it in edges)
+        wall = edges[-1].end - begin
+        busy = sum(it.duration for it in edges)
+
+        # estimate: walk back from the last edge, taking the edge which
+        # ended last before the current one started as its predecessor,
+        # searching only edges before the current one so 0ms edges end it.
+        ends = [it.end for it in edges]
+        i = len(edges) - 1
+        path = [edges[i]]
+        while (i := bisect.bisect_right(ends, edges[i].start, hi=i) - 1) >= 0:
+            path.append(edges[i])
+
+        size = max(1000, -(-wall // NINJALOG_BUCKETS))
+        buckets = [0] * (wall // size + 1)
+        for it in edges:
+            t = it.start - begin
+            while t < it.end - begin:
+                i = t // size
+                step = min(it.end - begin, (i + 1) * size) - t
+                buckets[i] += step
+                t += step
+
+        outputs = {out: it.hash for it in edges for out in it.outputs}
+        known = self.known.keys() | outputs.keys()
+        changed = sum(
+            1 for out, hash in outputs.items()
+            if out in self.known and self.known[out] != hash)
+
+        return {
+            'log': str(self.path),
+            'runs': len(self.runs[first:]),
+            'edges': len(edges),
+            'wall': wall / 1000,
+            'busy': busy / 1000,
+            'parallelism': busy / max(wall, 1),
+            'critical_path': {
+                'time': sum(it.duration for it in path) / 1000,
+                'edges': [
+                    {'output': it.name, 'duration': it.duration / 1000}
+                    for it in reversed(path)],
+            },
+            'slowest': [
+                {
+                    'output': it.name,
+                    'start': (it.start - begin) / 1000,
+                    'duration': it.duration / 1000,
+                }
+                for it in sorted(edges, key=lambda it: -it.duration)[:top]],
+            'timeline': {
+                'bucket': size / 1000,
+                'parallelism': [round(it / size, 2) for it in buckets],
+            },
+            'cache': {
+                'outputs': len(known),
+                'rebuilt': len(outputs),
+                'changed': changed,
+                'hit_ratio': 1 - len(outputs) / len(known),
+            },
+        }
+
+    # chrome trace events, edges are put on the first free lane.
+    def trace(self, first=-1):
+        lanes = []
+        events = []
+        for it in sorted(self.edges(first), key=lambda it: it.start):
+            for tid, end in enumerate(lanes):
+                if end <= it.start:
+                    break
+            else:
+                tid = len(lanes)
+                lanes.append(0)
+            lanes[tid] = it.end
+            events.append({
+                'name': it.name,
+                'cat': 'targets',
+                'ph': 'X',
+                'ts': it.start * 1000,
+                'dur': it.duration * 1000,
+                'pid': 0,
+                'tid': tid,
+                'args': {'outputs': it.outputs, 'hash': it.hash},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, out, first=-1):
+        if (report := self.report(first)) is None:
+            return None
+        out = Path(out)
+        with open(out/NINJALOG_REPORT, 'w') as f:
+            json.dump(report, f, indent=2)
+        with open(out/NINJALOG_TRACE, 'w') as f:
+            json.dump(self.trace(first), f)
+
+        cache = report['cache']
+        logger.info(
+            f'✓ 构建统计 {report["edges"]} edges in {report["wall"]:.0f}s, '
+            f'parallelism {report["parallelism"]:.1f}, '
+            f'critical path {report["critical_path"]["time"]:.0f}s, '
+            f'hit ratio {cache["hit_ratio"]:.1%}')
+        for it in report['slowest'][:5]:
+            logger.info(f'{it["duration"]:8.1f}s {it["output"]}')
+        return out/NINJALOG_REPORT
+
+    # follow the log while ninja runs, the report of every run since, ninja
+    # is restarted by the jobserver, is written into `out` when it finishes.
+    @contextlib.contextmanager
+    def watch(self, out, interval=NINJALOG_INTERVAL):
+        self.update()
+        first = self.mark()
+        stop = threading.Event()
+
+        def follow():
+            while not stop.wait(interval):
+                if self.update() and (edges := self.edges(first)):
+                    busy = sum(it.duration for it in edges)
+                    wall = max(it.end for it in edges) - min(it.start for it in edges)
+                    logger.info(
+                        f'ninja: {len(edges)} edges, parallelism '
+                        f'{busy / max(wall, 1):.1f}')
+
+        thread = threading.Thread(target=follow, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            self.update()
+            if not self.edges(first):
+                logger.info('ninja: no edges rebuilt.')
+            else:
+                self.write(out, first)
+
+
+def report(out):
+    log = NinjaLog(Path(out)/'.ninja_log')
+    log.update()
+    return log.write(out)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(report)
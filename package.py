@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
 
 import io
+import os
+import json
+import copy
+import mmap
+import fcntl
+import shutil
+import time
 import utils
+import ledger
+import archive
+import compress
 import string
 import base64
 import requests
@@ -9,10 +19,27 @@ import tarfile
 import zipfile
 import hashlib
 import tempfile
-import subprocess
+import functools
+import contextlib
+import multiprocessing
 from git import Repo
 from loguru import logger
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# files are read ahead of the tar writer, large ones are mapped instead.
+PREFETCH_DEPTH = 32
+PREFETCH_WORKERS = 8
+PREFETCH_MMAP_SIZE = 1 << 20
+# small files are kept as copies, in-place writes to them (stamps, refs)
+# must not leak into their duplicates.
+DEDUP_MIN_SIZE = 1 << 12
+# what a git export was made from, kept out of the package
+EXPORT_KEY = 'export.json'
+# versions and payload digests of the parts last built into an output, the
+# output is shared by all architectures
+PARTS_RECORD = '.parts-${architecture}.json'
 
 
 def explore_file(src: Path):
@@ -21,20 +48,67 @@ def explore_file(src: Path):
     if src.is_dir():
         for root, dirs, files in src.walk():
             rel = root.relative_to(src)
+            # walk in a stable order instead of the directory order
+            dirs.sort()
             for it in dirs:
-                yield rel/it
-            for it in files:
-                yield rel/it
-
-
-def explore_git(src: Path):
+                yield rel/it, root/it
+            for it in sorted(files):
+                yield rel/it, root/it
+
+
+def export_git(src: Path, depth: int = 1):
+    repo = Repo(src)
+    head = repo.head.commit.hexsha
+    tags = sorted(repo.git.tag('--points-at', 'HEAD').split())
+    dst = src.with_name(f'.{src.name}.git')
+
+    # reused while HEAD, depth and tags are the same, concurrent exports
+    # wait for the first one.
+    key = {'head': head, 'depth': depth, 'tags': tags}
+    with open(src.with_name(f'.{src.name}.git.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with contextlib.suppress(OSError, ValueError):
+            if json.loads((dst/EXPORT_KEY).read_text()) == key:
+                return dst
+        shutil.rmtree(dst, ignore_errors=True)
+
+        # fetch HEAD and its tags into a fresh shallow repo, then pack it
+        # into a single pack so that .git ships as few, well compressed
+        # files. the reflog (user, host, time) is dropped and the pack is
+        # written by one thread, so the export is reproducible.
+        with tempfile.TemporaryDirectory(dir=src.parent) as tmp:
+            spec = ['HEAD', *(f'refs/tags/{it}:refs/tags/{it}' for it in tags)]
+            export = Repo.init(tmp)
+            export.git.fetch(f'--depth={depth}', '--no-tags', src.as_uri(), *spec)
+            export.git.update_ref('--no-deref', 'HEAD', head)
+            if 'origin' in repo.remotes:
+                export.create_remote('origin', repo.remotes.origin.url)
+            export.git.read_tree('HEAD')
+            export.git(c='pack.threads=1').repack(
+                '-a', '-d', '-f', '-q', '--depth=250', '--window=250')
+            shutil.rmtree(Path(tmp)/'.git/logs', ignore_errors=True)
+            (Path(tmp)/'.git/FETCH_HEAD').unlink(missing_ok=True)
+            (Path(tmp)/'.git'/EXPORT_KEY).write_text(json.dumps(key))
+            os.rename(Path(tmp)/'.git', dst)
+
+    logger.info(f'✓ 导出仓库 {dst}')
+    return dst
+
+
+def explore_git(src: Path, repack: bool = False, depth: int = 1):
     assert src.is_dir()
 
-    for it in Repo(src).tree().traverse():
-        yield it.path
-    git = src/'.git'
-    for it in explore_file(git):
-        yield '.git'/it
+    # a single ls-tree lists the whole tree, -t keeps directory entries
+    tree = Repo(src).git.ls_tree('-r', '-t', '-z', '--name-only', 'HEAD')
+    for it in tree.split('\0'):
+        if it:
+            yield Path(it), src/it
+
+    git = export_git(src, depth) if repack else src/'.git'
+    yield Path('.git'), git
+    for rel, it in explore_file(git):
+        if rel != Path(EXPORT_KEY):
+            yield '.git'/rel, it
 
 
 def emit(out, src, git):
@@ -45,14 +119,17 @@ def emit(out, src, git):
     if isinstance(src, bytes):
         yield {'out': out, 'src': src}
         return
-    for src, it in explore(src, git):
+    for src, rel, it in explore(src, git):
         yield {
-            'out': out/src.name/it if isdir else out/it,
-            'src': src/it}
+            'out': out/src.name/rel if isdir else out/rel,
+            'src': it}
 
 
 def explore(src, git):
-    explore = explore_git if git else explore_file
+    if isinstance(git, dict):
+        explore = functools.partial(explore_git, **git)
+    else:
+        explore = explore_git if git else explore_file
 
     if not isinstance(src, list):
         src = [src]
@@ -61,9 +138,9 @@ def explore(src, git):
         if not src.exists():
             logger.warning(f'source not found: "{src}"')
             continue
-        yield src, Path('.')
-        for it in explore(src):
-            yield src, it
+        yield src, Path('.'), src
+        for rel, it in explore(src):
+            yield src, rel, it
 
 
 def reset(info):
@@ -75,25 +152,104 @@ def reset(info):
     info.mode |= 0o200
 
 
-def add_bin(tar, out, src, mod=None):
+# emit repeated payloads as hard links to their first copy
+class Links(object):
+    def __init__(self):
+        self.first = {}
+        self.paths = {}
+        self.count = 0
+        self.saved = 0
+
+    def __call__(self, tar, info, digest):
+        if info.size < DEDUP_MIN_SIZE:
+            return False
+
+        key = (digest, info.mode)
+        target = self.first.get(key)
+        # the first copy may have been overwritten by a later entry
+        if target and target != info.name and self.paths[target] == key:
+            link = tarfile.TarInfo(info.name)
+            link.type = tarfile.LNKTYPE
+            link.linkname = target
+            link.mode = info.mode
+            reset(link)
+            tar.addfile(link)
+            self.paths[info.name] = key
+            self.count += 1
+            self.saved += info.size
+            return True
+
+        self.first[key] = info.name
+        self.paths[info.name] = key
+        return False
+
+
+def add_bin(tar, out, src, mod=None, links=None):
     assert tar, out and isinstance(src, bytes)
 
     info = tarfile.TarInfo(str(out))
     info.mode = mod or 0o644
     info.size = len(src)
     reset(info)
+    if links and links(tar, info, hashlib.sha256(src).hexdigest()):
+        return
     tar.addfile(info, io.BytesIO(src))
 
 
-def add_file(tar, out, src, mod=None):
-    assert tar, out and src.exists()
+def load_file(tar, out, src, digest=False):
+    if src.is_dir():
+        return None
+    if not src.exists():
+        raise FileNotFoundError(src)
+
+    info = tar.gettarinfo(src, str(out))
+    with open(src, 'rb') as f:
+        if info.size < PREFETCH_MMAP_SIZE:
+            data = f.read()
+            info.size = len(data)
+        else:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data.madvise(mmap.MADV_WILLNEED)
+    if digest:
+        digest = hashlib.sha256(data).hexdigest()
+    return info, data, digest
+
+
+def normalize(mode):
+    return 0o755 if mode & 0o111 else 0o644
 
-    info = tar.gettarinfo(src, out)
-    info.mode = mod or info.mode
+
+def add_file(tar, info, data, digest=None, mod=None, links=None, norm=False):
+    assert tar, info
+
+    info.mode = mod or (normalize(info.mode) if norm else info.mode)
     reset(info)
 
-    with open(src, 'rb') as f:
-        tar.addfile(info, f)
+    if links and links(tar, info, digest):
+        if not isinstance(data, bytes):
+            data.close()
+    elif isinstance(data, bytes):
+        tar.addfile(info, io.BytesIO(data))
+    else:
+        with data:
+            tar.addfile(info, data)
+
+
+def prefetch(tar, data, digest=False):
+    def load(it):
+        if isinstance(src := it.get('src'), Path):
+            return load_file(tar, it.get('out'), src, digest)
+
+    with ThreadPoolExecutor(PREFETCH_WORKERS) as pool:
+        queue = deque()
+        for it in data:
+            queue.append((it, pool.submit(load, it)))
+            if len(queue) >= PREFETCH_DEPTH:
+                it, future = queue.popleft()
+                yield it, future.result()
+        while queue:
+            it, future = queue.popleft()
+            yield it, future.result()
 
 
 def add_dir(tar, out, mod=None):
@@ -114,7 +270,7 @@ def add_dir(tar, out, mod=None):
     cache.add(out)
 
 
-def tar(path, data):
+def tar(path, data, compression=None, dedup=False, reproducible=False):
     if not data:
         logger.warning('no work to do.')
         return
@@ -122,8 +278,18 @@ def tar(path, data):
         data = [data]
     assert hasattr(data, '__iter__'), f'bad data format: "{data}"'
 
-    with tarfile.open(path, mode='w:xz', format=tarfile.GNU_FORMAT, dereference=True) as tar:
-        for it in data:
+    if isinstance(path, (str, Path)):
+        file = open(path, 'wb')
+    else:
+        file = contextlib.nullcontext(path)
+
+    with (
+        file as f,
+        compress.writer(f, **(compression or {})) as z,
+        tarfile.open(fileobj=z, mode='w', format=tarfile.GNU_FORMAT, dereference=True) as tar,
+    ):
+        links = Links() if dedup else None
+        for it, file in prefetch(tar, data, dedup):
             out = it.get('out')
             src = it.get('src')
             mod = it.get('mod')
@@ -132,13 +298,14 @@ def tar(path, data):
             assert mod is None or isinstance(mod, int)
 
             if isinstance(src, bytes):
-                add_bin(tar, out, src, mod)
-            elif not src or src.is_dir():
+                add_bin(tar, out, src, mod, links)
+            elif not src or not file:
                 add_dir(tar, out, mod)
-            elif src.exists():
-                add_file(tar, out, src, mod)
             else:
-                raise FileNotFoundError(src)
+                add_file(tar, *file, mod, links, reproducible)
+
+    if links and links.count:
+        logger.info(f'✓ 去重 {links.count} 个文件, 节省 {links.saved} 字节')
 
 
 def base64_md5_file(path):
@@ -172,8 +339,78 @@ def download(url, out):
         return dst
 
 
+def list_tar(fileobj, format):
+    with (
+        compress.reader(fileobj, format) as f,
+        tarfile.open(fileobj=f, mode='r|') as tar,
+    ):
+        for info in tar:
+            hash = hashlib.sha256()
+            if info.isfile() and (data := tar.extractfile(info)):
+                while s := data.read(1 << 20):
+                    hash.update(s)
+            yield info.name, (
+                info.type,
+                info.mode,
+                info.uid,
+                info.gid,
+                info.mtime,
+                info.size,
+                info.linkname,
+                hash.hexdigest())
+
+
+def list_deb(path):
+    members = {}
+    with open(path, 'rb') as f:
+        for name, member in archive.read_ar(f):
+            if '.tar' in name:
+                members[name] = list(list_tar(member, compress.format_of(name)))
+            else:
+                members[name] = member.read()
+    return members
+
+
+def diff_deb(a, b, limit=20):
+    a, b = list_deb(a), list_deb(b)
+    diff = []
+    if list(a) != list(b):
+        diff.append(f'members: {list(a)} != {list(b)}')
+    for name in a.keys() & b.keys():
+        if isinstance(a[name], bytes):
+            if a[name] != b[name]:
+                diff.append(f'{name}: content differs')
+            continue
+        x, y = dict(a[name]), dict(b[name])
+        if [k for k, _ in a[name]] != [k for k, _ in b[name]]:
+            diff.append(f'{name}: entry order differs')
+        for it in sorted(x.keys() | y.keys()):
+            if x.get(it) != y.get(it):
+                diff.append(f'{name}: {it}: {x.get(it)} != {y.get(it)}')
+    return diff[:limit]
+
+
+class Counter(io.RawIOBase):
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.size += len(b)
+        return len(b)
+
+
+def _debuild(pkg, output, section, exclude):
+    pkg.debuild(output, section, exclude)
+    return output
+
+
+# `any` is where mode independent outputs come from, the output of the
+# `shared` mode when there is one, which may not be built yet.
 class Output(object):
-    def __init__(self, root, arch):
+    def __init__(self, root, arch, shared=None):
         self.any = None
         for it in utils.__MODE__:
             out = utils.target_output(root, arch, it)
@@ -181,19 +418,33 @@ class Output(object):
             if not self.any and Path(out).is_dir():
                 self.any = out
 
+        if shared:
+            self.any = self.__dict__[shared]
         assert self.any, 'no valid out path found.'
 
 
 @utils.record
 class Package(object):
-    def __init__(self, root, arch, control, resource, define=None):
+    def __init__(
+        self,
+        root,
+        arch,
+        control,
+        resource,
+        define=None,
+        compression=None,
+        dedup=False,
+        reproducible=False,
+        split=None,
+        shared=None,
+    ):
         root = Path(root).resolve()
         assert root.is_dir(), f'bad flutter root path: "{root}"'
         self.globals = {
             'tag': utils.flutter_tag(root),
             'root': root,
             'arch': arch,
-            'output': Output(root, arch),
+            'output': Output(root, arch, shared),
             'version': utils.engine_version(root),
             'architecture': utils.termux_arch(arch),
         }
@@ -202,6 +453,10 @@ class Package(object):
         }
         self.control = control
         self.resource = resource
+        self.compression = compression or {}
+        self.dedup = dedup
+        self.reproducible = reproducible
+        self.split = split or {}
         self.__dict__.update(self.globals)
         self.__dict__.update(self.defines)
 
@@ -229,6 +484,21 @@ class Package(object):
         else:
             raise ValueError(f'bad name: "{name}"')
 
+    # sources of all resources below `out`, relative to it and without
+    # reading them, so they can be known before they are built.
+    def requires(self, out):
+        out = Path(out)
+        for data in self.resource.values():
+            if data.get('binary', False):
+                continue
+            dep = data.get('define', {}).items()
+            dep = {k: eval(v, self.globals, self.defines) for k, v in dep}
+            src = data.get('source', [])
+            for it in [src] if isinstance(src, str) else src:
+                path = Path(self.__format__(it, **dep))
+                if path.is_relative_to(out):
+                    yield path.relative_to(out).as_posix()
+
     def gen_resource_internal(self, name=None):
         if not (data := self.resource.get(name)):
             raise ValueError(f'unknown resource name: "{name}"')
@@ -238,12 +508,10 @@ class Package(object):
         out = data.get('output')
         bin = data.get('binary', False)
         mod = data.get('mode')
-        dep = data.get('define', {})
+        dep = data.get('define', {}).items()
+        dep = {k: eval(v, self.globals, self.defines) for k, v in dep}
         ext = {}
 
-        for k, v in dep.items():
-            dep[k] = eval(v, self.globals, self.defines)
-
         # expect None, str, int
         if isinstance(mod, str):
             mod = int(mod, 8)
@@ -304,28 +572,208 @@ class Package(object):
                     return False
         return True
 
-    def debuild(self, output, section=None):
+    def debuild(self, output, section=None, exclude=None):
         output = Path(output or '.').expanduser().resolve()
         if not output.parent.is_dir() or output.is_dir():
             raise ValueError(f'bad output path: "{output}"')
 
-        with tempfile.TemporaryDirectory() as tmp:
-            info = Path(tmp, 'debian-binary')
-            ctrl = Path(tmp, 'control.tar.xz')
-            data = Path(tmp, 'data.tar.xz')
+        data = self.gen_resource(section)
+        if exclude:
+            data = (it for it in data if str(it['out']) not in exclude)
+
+        suffix = compress.SUFFIX[self.compression.get('format', 'xz')]
+        partial = output.with_name(f'.{output.name}.part')
+
+        try:
+            with open(partial, 'wb') as f:
+                ar = archive.ArWriter(f)
+                ar.add('debian-binary', b'2.0\n')
+                with ar.member('control.tar.xz') as m:
+                    tar(m, self.gen_control())
+                with ar.member(f'data.tar{suffix}') as m:
+                    tar(m,
+                        data,
+                        self.compression,
+                        self.dedup,
+                        self.reproducible)
+            os.replace(partial, output)
+        finally:
+            partial.unlink(missing_ok=True)
 
-            with open(info, 'wb+') as f:
-                f.write(b'2.0\n')
-            tar(ctrl, self.gen_control())
-            tar(data, self.gen_resource(section))
+        logger.info(f'✓ 构建完成 {output}')
 
-            subprocess.run(
-                    ['ar', 'rc', output, info, ctrl, data],
-                    check=True,
-                    stderr=True,
-                    stdout=True)
+    # `versions` maps groups to the version of their part and `pins` to the
+    # least versions of the parts they depend on, so an unchanged part is
+    # not upgraded with the others.
+    def gen_parts(self, versions=None, pins=None):
+        name = self.control['Package']
+        version = self.control['Version']
+        versions = versions or {}
+        pins = pins or {}
+        parts = {}
+
+        for group, conf in self.split.items():
+            pin = pins.get(group, {})
+            deps = [
+                f'{name}-{it} (>= {pin.get(it, versions.get(it, version))})'
+                for it in conf.get('depends', [])]
+            control = {
+                k: v for k, v in self.control.items()
+                if k not in ('Depends', 'Pre-Depends')}
+            control['Package'] = f'{name}-{group}'
+            control['Version'] = versions.get(group, version)
+            if deps:
+                control['Depends'] = ', '.join(deps)
+            # take over files from the monolithic package
+            older = f'{name} (<< {control["Version"]})'
+            control['Breaks'] = older
+            control['Replaces'] = older
+            control.update(conf.get('control', {}))
+            parts[group] = (control, conf['resource'])
+
+        # the meta package keeps the original name and external depends
+        control = dict(self.control)
+        deps = [f'{name}-{it} (>= {versions.get(it, version)})' for it in self.split]
+        if it := control.get('Depends'):
+            deps.insert(0, it)
+        control['Depends'] = ', '.join(deps)
+        parts[None] = (control, [])
+        return parts
+
+    # digest of what a part installs, paths, modes and contents.
+    def digest_part(self, resource, exclude):
+        def load(it):
+            src = it.get('src')
+            if isinstance(src, bytes):
+                return hashlib.sha256(src).hexdigest(), it.get('mod')
+            if not src or not src.is_file():
+                return None, it.get('mod')
+            mod = it.get('mod') or src.stat().st_mode & 0o777
+            return ledger.hash_file(src), normalize(mod) if self.reproducible else mod
+
+        data = [
+            it for it in self.gen_resource(resource)
+            if str(it['out']) not in exclude]
+        hash = hashlib.sha256()
+        with ThreadPoolExecutor(PREFETCH_WORKERS) as pool:
+            for it, (digest, mod) in zip(data, pool.map(load, data)):
+                hash.update(f'{it["out"]}\0{mod}\0{digest}\n'.encode())
+        return hash.hexdigest()
+
+    # a part keeps the version it was last built with while its payload is
+    # unchanged, the versions are recorded in `PARTS_RECORD` of `output`.
+    def debuild_parts(self, output):
+        output = Path(output or '.').expanduser().resolve()
+        if not output.is_dir():
+            raise ValueError(f'bad output directory: "{output}"')
+        if not self.split:
+            raise ValueError('no split defined')
+
+        # a file emitted by several groups belongs to the group emitting it
+        # last, as later entries win in the monolithic package.
+        groups = {g: conf['resource'] for g, conf in self.split.items()}
+        groups = {r: g for g, res in groups.items() for r in res}
+        owner = {}
+        for name in self.resource:
+            if (group := groups.get(name, ...)) is ...:
+                logger.warning(f'resource not in any part: "{name}"')
+                continue
+            for it in self.gen_resource(name):
+                src = it.get('src')
+                if isinstance(src, bytes) or src and src.is_file():
+                    owner[str(it['out'])] = group
+
+        record = output/self.__format__(PARTS_RECORD)
+        last = json.loads(record.read_text()) if record.is_file() else {}
+        version = self.__format__(self.control['Version'])
+        versions = {}
+        digests = {}
+        pins = {}
+        for group, conf in self.split.items():
+            exclude = {k for k, v in owner.items() if v != group}
+            control = {
+                k: v for k, v in (self.control | conf.get('control', {})).items()
+                if k not in ('Version', 'Depends', 'Pre-Depends')}
+            digests[group] = ledger.fingerprint(
+                self.digest_part(conf['resource'], exclude), control)
+            if (it := last.get(group)) and it['digest'] == digests[group]:
+                versions[group] = it['version']
+                pins[group] = it['depends']
+            else:
+                versions[group] = version
+        for group, conf in self.split.items():
+            if group not in pins:
+                pins[group] = {it: versions[it] for it in conf.get('depends', [])}
+
+        parts = self.gen_parts(versions, pins)
+        workers = min(len(parts), os.cpu_count())
+        threads = self.compression.get('threads') or os.cpu_count()
+        jobs = []
+        debs = []
+
+        for group, (control, resource) in parts.items():
+            part = copy.copy(self)
+            part.control = control
+            part.compression = self.compression | {
+                'threads': max(1, threads // workers)}
+            name = self.__format__(control['Package'])
+            arch = self.__format__(control['Architecture'])
+            deb = output/f'{name}_{self.__format__(control["Version"])}_{arch}.deb'
+            debs.append(deb)
+            if group and versions[group] != version and deb.is_file():
+                logger.info(f'✓ 未变更 {deb}')
+                continue
+            exclude = {k for k, v in owner.items() if v != group}
+            jobs.append((part, deb, resource, exclude))
+
+        # forked from a forkserver, the caller may be running threads
+        forkserver = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(workers, mp_context=forkserver) as pool:
+            futures = [pool.submit(_debuild, *it) for it in jobs]
+            for it in futures:
+                it.result()
+
+        record.write_text(json.dumps({
+            k: {'version': versions[k], 'digest': v, 'depends': pins[k]}
+            for k, v in digests.items()}, indent=2))
+        return debs
+
+    def verify_reproducible(self, section=None):
+        with tempfile.TemporaryDirectory() as tmp:
+            a = Path(tmp, 'a.deb')
+            b = Path(tmp, 'b.deb')
+            self.debuild(a, section)
+            self.debuild(b, section)
+
+            digest = ledger.hash_file(a)
+            if digest == ledger.hash_file(b):
+                logger.info(f'✓ 可复现构建 sha256:{digest}')
+                return digest
+
+            for it in diff_deb(a, b):
+                logger.error(it)
+            return None
 
-        logger.info(f'✓ 构建完成 {output}')
+    def benchmark(self, section=None, formats=None):
+        formats = formats or ['xz', 'xz:9', 'zstd', 'zstd:19', 'gzip', 'none']
+        if isinstance(formats, str):
+            formats = formats.split(',')
+        threads = self.compression.get('threads')
+        report = {}
+
+        for it in formats:
+            format, _, level = str(it).partition(':')
+            level = int(level) if level else None
+            sink = Counter()
+            start = time.perf_counter()
+            tar(sink, self.gen_resource(section), {
+                'format': format,
+                'level': level,
+                'threads': threads}, self.dedup, self.reproducible)
+            elapsed = time.perf_counter() - start
+            report[it] = {'size': sink.size, 'time': round(elapsed, 3)}
+            logger.info(f'{it:<10} {sink.size:>14,d} bytes {elapsed:>9.2f} s')
+        return report
 
 
 if __name__ == '__main__':
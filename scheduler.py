@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+from loguru import logger
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Task(object):
+    def __init__(self, name, func, deps, pool):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.pool = pool
+
+
+# run tasks as soon as their dependencies finish, a task may take a slot of
+# a named pool to bound how many tasks of its kind run at the same time.
+# `abort` is called when a task fails or the run is interrupted, to stop the
+# tasks still running instead of waiting for them.
+class Scheduler(object):
+    def __init__(self, workers: int = None, abort=None, **pools):
+        self.workers = workers or os.cpu_count()
+        self.abort = abort
+        self.pools = pools
+        self.tasks = {}
+
+    def add(self, name, func, *deps, pool=None):
+        assert name not in self.tasks, f'duplicated task: "{name}"'
+        assert pool is None or pool in self.pools, f'unknown pool: "{pool}"'
+        for it in deps:
+            assert it in self.tasks, f'unknown dependency: "{it}"'
+
+        self.tasks[name] = Task(name, func, deps, pool)
+        return name
+
+    def __call__(self):
+        pending = dict(self.tasks)
+        running = {}
+        finished = set()
+        usage = {k: 0 for k in self.pools}
+
+        def ready(task):
+            if not all(it in finished for it in task.deps):
+                return False
+            if task.pool:
+                return usage[task.pool] < self.pools[task.pool]
+            return True
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while pending or running:
+                for name, task in list(pending.items()):
+                    if not ready(task):
+                        continue
+                    if task.pool:
+                        usage[task.pool] += 1
+                    del pending[name]
+                    logger.debug(f'start task {name}')
+                    running[executor.submit(task.func)] = task
+
+                if not running:
+                    raise RuntimeError(f'unresolved tasks: {list(pending)}')
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if task.pool:
+                        usage[task.pool] -= 1
+                    if error := future.exception():
+                        raise error
+                    finished.add(task.name)
+                    logger.debug(f'finish task {task.name}')
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if self.abort:
+                self.abort()
+            raise
+        executor.shutdown()
@@ -1,30 +1,177 @@
 #!/usr/bin/env python3
 
 import os
+import gzip
+import json
+import fcntl
+import lzma
+import time
+import random
+import shutil
 import utils
+import hashlib
 import pathlib
+import fnmatch
+import functools
+import contextlib
 import asyncio
 import aiohttp
+import requests
+import tarfile
+import archive
+import compress
 import tempfile
-import itertools
-import subprocess
 import urllib.parse
+import multiprocessing
 from loguru import logger
+from concurrent.futures import ProcessPoolExecutor
+
+DOWNLOAD_BACKOFF = 1
+DOWNLOAD_CHUNK_MIN = 1 << 16
+DOWNLOAD_CHUNK_MAX = 1 << 20
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+PRUNE_PREFIX = 'data/data/com.termux/files/usr/'
+# what a cross build compiles and links against, relative to PRUNE_PREFIX.
+PRUNE_INCLUDE = [
+    'include/*',
+    'lib/*.so',
+    'lib/*.so.*',
+    'lib/*.a',
+    'lib/*.o',
+    'lib/pkgconfig/*',
+    'share/pkgconfig/*',
+    'lib/*/include/*',
+]
+
+
+def _sha256(path):
+    hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while s := f.read(1 << 20):
+            hash.update(s)
+    return hash.hexdigest()
+
+
+# debs stored by their sha256 from the Packages index, least recently used
+# ones are evicted once the cache grows over `size` bytes.
+class Cache(object):
+    def __init__(self, path, size=None):
+        self.path = pathlib.Path(path).expanduser().resolve()
+        self.size = size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, sha256):
+        path = self.path/f'{sha256}.deb'
+        if not path.is_file():
+            return None
+        if _sha256(path) != sha256:
+            logger.warning(f'corrupted cache: "{path.name}"')
+            path.unlink()
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, sha256, src):
+        path = self.path/f'{sha256}.deb'
+        os.replace(src, path)
+        return path
+
+    def evict(self):
+        if self.size is None:
+            return
+        debs = sorted(
+            (it.stat().st_mtime, it.stat().st_size, it)
+            for it in self.path.glob('*.deb'))
+        total = sum(it[1] for it in debs)
+        for _, size, it in debs:
+            if total <= self.size:
+                break
+            it.unlink()
+            total -= size
+            logger.debug(f'evict {it.name}')
+
+
+# downloads with at most `jobs` requests in flight, each one retried with
+# exponential backoff and resumed from its partial file with Range.
+class Downloader(object):
+    def __init__(self, sess, jobs=8, retries=5, timeout=60):
+        self.sess = sess
+        self.limit = asyncio.Semaphore(jobs)
+        self.retries = retries
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=timeout, sock_read=timeout)
+        self.stats = {}
+        self.pending = {}
+
+    # a package of arch `all` is downloaded once for the sysroots of all
+    # arches.
+    async def __call__(self, cache, pkg):
+        if (sha256 := pkg['sha256']) not in self.pending:
+            self.pending[sha256] = asyncio.ensure_future(self._download(cache, pkg))
+        return pkg | {'path': await asyncio.shield(self.pending[sha256])}
+
+    async def _download(self, cache, pkg):
+        name = pkg['name']
+        if path := cache.get(pkg['sha256']):
+            logger.info(f'✓ 命中缓存 {name}')
+            return path
 
-
-async def _download(sess, url, dst):
-    path = urllib.parse.urlparse(url).path
-    name = pathlib.Path(path).name
-    path = pathlib.Path(dst, name)
-    try:
-        async with sess.get(url) as resp:
+        part = cache.path/f'{pkg["sha256"]}.part'
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.limit:
+                    await self._fetch(pkg['url'], part)
+                if await asyncio.to_thread(_sha256, part) == pkg['sha256']:
+                    return cache.put(pkg['sha256'], part)
+                part.unlink()
+                error = 'bad sha256'
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                error = repr(e)
+            if attempt == self.retries:
+                break
+            delay = min(DOWNLOAD_BACKOFF << attempt, 60) * (0.5 + random.random())
+            logger.warning(f'{name}: {error}, retry in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+        part.unlink(missing_ok=True)
+        raise RuntimeError(f'✗ 下载失败 {name}: {error}')
+
+    async def _fetch(self, url, part):
+        host = urllib.parse.urlsplit(url).netloc
+        stat = self.stats.setdefault(host, {'bytes': 0, 'time': 0.0, 'count': 0})
+        offset = part.stat().st_size if part.is_file() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        start = time.monotonic()
+        async with self.sess.get(url, headers=headers, timeout=self.timeout) as resp:
+            if resp.status == 416:
+                return
             resp.raise_for_status()
-            with open(path, 'wb') as f:
-                async for chunk in resp.content.iter_chunked(8192):
-                    f.write(chunk)
-            return path
-    except Exception:
-        raise RuntimeError(f'✗ 下载失败 {name}')
+            if resp.status != 206:
+                offset = 0
+            elif offset:
+                logger.debug(f'resume {url} at {offset}')
+
+            # grow the chunk while reads keep filling it, a fast mirror is
+            # drained with fewer and larger writes.
+            chunk = DOWNLOAD_CHUNK_MIN
+            with open(part, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                while data := await resp.content.read(chunk):
+                    f.write(data)
+                    stat['bytes'] += len(data)
+                    if len(data) == chunk and chunk < DOWNLOAD_CHUNK_MAX:
+                        chunk <<= 1
+        stat['time'] += time.monotonic() - start
+        stat['count'] += 1
+
+    def report(self):
+        for host, it in sorted(self.stats.items()):
+            speed = it['bytes'] / max(it['time'], 1e-6) / (1 << 20)
+            logger.info(
+                f'{host}: {it["count"]} files, {it["bytes"] / (1 << 20):.1f} MiB, '
+                f'{speed:.2f} MiB/s per request')
 
 
 async def _spawn(tasks):
@@ -40,57 +187,405 @@ async def _spawn(tasks):
     return [r.result() for r in done]
 
 
-async def _download_packages(out, arch, *src):
-    timeout = aiohttp.ClientTimeout(total=500)
-    async with aiohttp.ClientSession(timeout=timeout) as sess:
-        urls = await _spawn([
-            _resolve_packages(sess, arch, **it) for it in src
-        ])
-        urls = itertools.chain(*urls)
-        return await _spawn([
-            _download(sess, url, out) for url in urls
-        ])
-
-
-async def _resolve_packages(sess, arch, repo, dist, pkgs):
-    if not repo or not pkgs:
-        return {}
-
-    bin = f'dists/{dist}/main/binary-{arch}/Packages'
-    url = urllib.parse.urljoin(repo, bin)
-
-    current = None
-    package = {}
-
-    async with sess.get(url) as resp:
-        resp.raise_for_status()
-        async for line in resp.content:
-            line = line.decode().strip()
-
-            if line.startswith('Package:'):
-                current = line.split(':')[1].strip()
-            elif current in pkgs and line.startswith('Filename:'):
-                urlpath = line.split(':')[1].strip()
-                package[current] = urllib.parse.urljoin(repo, urlpath)
-
-            if len(package) == len(pkgs):
-                break
-
-    remains = [it for it in pkgs if it not in package]
-    if remains:
-        raise FileNotFoundError(f'packages{remains} not found.')
-    return package.values()
+async def _index_packages(sess, cache, arch, depends, *src, timeout=None):
+    indexes = await asyncio.gather(*[
+        _fetch_index(sess, cache, arch, it['repo'], it['dist'], timeout)
+        for it in src
+    ])
+    return _resolve_packages(src, indexes, depends)
+
+
+def _parse_index(text):
+    index = {}
+    for block in text.split('\n\n'):
+        record = {}
+        for line in block.splitlines():
+            if not line or line[0].isspace():
+                continue
+            key, _, value = line.partition(':')
+            record[key] = value.strip()
+        if name := record.get('Package'):
+            index[name] = {
+                'version': record.get('Version'),
+                'filename': record.get('Filename'),
+                'size': int(record.get('Size', 0)),
+                'sha256': record.get('SHA256'),
+                'depends': ', '.join(filter(None, [
+                    record.get('Pre-Depends'),
+                    record.get('Depends')])),
+            }
+    return index
+
+
+# fetch Packages of a repo in its smallest form, the parsed index is kept
+# in the cache and revalidated with ETag / Last-Modified.
+async def _fetch_index(sess, cache, arch, repo, dist, timeout=None):
+    base = urllib.parse.urljoin(repo, f'dists/{dist}/main/binary-{arch}/')
+    key = hashlib.sha256(base.encode()).hexdigest()[:16]
+    path = cache.path/'index'/f'{key}.json'
+    saved = json.loads(path.read_text()) if path.is_file() else {}
+
+    for name, decode in (
+        ('Packages.xz', lzma.decompress),
+        ('Packages.gz', gzip.decompress),
+        ('Packages', bytes),
+    ):
+        url = base + name
+        headers = {}
+        if saved.get('url') == url:
+            if etag := saved.get('etag'):
+                headers['If-None-Match'] = etag
+            if modified := saved.get('modified'):
+                headers['If-Modified-Since'] = modified
+
+        async with sess.get(url, headers=headers, timeout=timeout) as resp:
+            if resp.status == 304:
+                logger.debug(f'index not modified: {url}')
+                return saved['packages']
+            if resp.status == 404:
+                continue
+            resp.raise_for_status()
+            packages = _parse_index(decode(await resp.read()).decode())
+            saved = {
+                'url': url,
+                'etag': resp.headers.get('ETag'),
+                'modified': resp.headers.get('Last-Modified'),
+                'packages': packages,
+            }
+
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(json.dumps(saved))
+        return packages
+
+    raise FileNotFoundError(f'no Packages index found in "{base}"')
+
+
+# "a (>= 1), b | c" -> (('a',), ('b', 'c'))
+@functools.cache
+def _parse_depends(depends):
+    return tuple(
+        tuple(
+            alt.split('(')[0].split(':')[0].strip()
+            for alt in group.split('|'))
+        for group in depends.split(',') if group.strip())
+
+
+def _resolve_packages(src, indexes, depends=False):
+    def find(name, prefer):
+        if name in indexes[prefer]:
+            return prefer
+        for i, index in enumerate(indexes):
+            if name in index:
+                return i
+        return None
+
+    def select(name, i):
+        item = indexes[i][name]
+        return {
+            'name': name,
+            'version': item['version'],
+            'url': urllib.parse.urljoin(src[i]['repo'], item['filename']),
+            'size': item['size'],
+            'sha256': item['sha256'],
+            'depends': item['depends'],
+            'repo': i,
+            'prune': src[i].get('prune'),
+        }
+
+    selected = {}
+    for i, it in enumerate(src):
+        remains = [name for name in it['pkgs'] if name not in indexes[i]]
+        if remains:
+            raise FileNotFoundError(f'packages{remains} not found.')
+        for name in it['pkgs']:
+            selected[name] = select(name, i)
+
+    if not depends:
+        return list(selected.values())
+
+    # the closure over Depends across all repos, an alternative that is
+    # already selected wins over the first available one.
+    roots = set(selected)
+    queue = list(selected.values())
+    while queue:
+        pkg = queue.pop()
+        for group in _parse_depends(pkg['depends']):
+            if any(it in selected for it in group):
+                continue
+            for name in group:
+                if (i := find(name, pkg['repo'])) is not None:
+                    selected[name] = select(name, i)
+                    queue.append(selected[name])
+                    break
+            else:
+                logger.warning(f'{pkg["name"]}: unresolved depends {group}')
+
+    if added := sorted(selected.keys() - roots):
+        logger.info(f'✓ 依赖解析 +{len(added)} {", ".join(added)}')
+    return list(selected.values())
+
+
+def _pruned(name, prune):
+    if prune is None:
+        return False
+    if not name.startswith(PRUNE_PREFIX):
+        return True
+    name = name[len(PRUNE_PREFIX):]
+    if not any(fnmatch.fnmatchcase(name, it) for it in prune['include']):
+        return True
+    return any(fnmatch.fnmatchcase(name, it) for it in prune['exclude'])
+
+
+# file contents shared by the sysroots of all arches, named by sha256 and
+# mode and hardlinked into every sysroot that installs them. an object only
+# linked from the store itself is garbage.
+class Store(object):
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def lock(self, op=fcntl.LOCK_SH):
+        with open(self.path/'.lock', 'a') as f:
+            fcntl.flock(f, op)
+            yield
+
+    def put(self, fileobj, info):
+        hash = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            while s := fileobj.read(1 << 20):
+                hash.update(s)
+                f.write(s)
+        os.chmod(tmp, info.mode)
+        os.utime(tmp, (info.mtime, info.mtime))
+
+        path = self.path/f'{hash.hexdigest()}.{info.mode:o}'
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        os.unlink(tmp)
+        return path
+
+    def link(self, src, dst):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        dst.unlink(missing_ok=True)
+        os.link(src, dst)
+
+    def gc(self):
+        count = size = 0
+        with self.lock(fcntl.LOCK_EX):
+            for it in self.path.iterdir():
+                stat = it.stat()
+                if it.name != '.lock' and stat.st_nlink == 1:
+                    it.unlink()
+                    count += 1
+                    size += stat.st_size
+        return count, size
+
+
+def _untar(tar, out, store, filter):
+    for info in tar:
+        if (info := filter(info, out)) is None:
+            continue
+        if info.isreg():
+            store.link(store.put(tar.extractfile(info), info), out/info.name)
+        else:
+            tar.extract(info, out, filter='fully_trusted')
+
+
+# the equivalent of `dpkg -x`, data.tar is streamed out of the deb and its
+# regular files are linked from the store. files rejected by `prune` are
+# never written. returns the files and links it installed.
+def _extract(out, store, path, prune=None):
+    files = []
+
+    def filter(member, dest):
+        member = tarfile.tar_filter(member, dest)
+        name = os.path.normpath(member.name)
+        if member.isdir():
+            return None if prune else member
+        if _pruned(name, prune):
+            return None
+        if member.islnk() and _pruned(os.path.normpath(member.linkname), prune):
+            return None
+        files.append(name)
+        return member
+
+    with open(path, 'rb') as f:
+        for name, member in archive.read_ar(f):
+            if not name.startswith('data.tar'):
+                continue
+            data = compress.reader(member, compress.format_of(name))
+            with store.lock(), tarfile.open(fileobj=data, mode='r|') as tar:
+                _untar(tar, out, store, filter)
+            return sorted(files)
+    raise ValueError(f'no data.tar in "{path}"')
+
+
+# a snapshot is named by what it contains: (name, sha256, prune) of every
+# package installed for `arch`.
+def _snapshot_name(arch, pkgs):
+    key = json.dumps([arch, sorted(pkgs)], sort_keys=True)
+    return f'sysroot-{arch}-{hashlib.sha256(key.encode()).hexdigest()[:16]}.tar.xz'
+
+
+def _open_snapshot(src, name):
+    if urllib.parse.urlsplit(src).scheme in ('http', 'https'):
+        resp = requests.get(f'{src.rstrip("/")}/{name}', stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            return None
+        resp.raw.decode_content = True
+        return contextlib.closing(resp.raw)
+    path = pathlib.Path(src).expanduser()/name
+    return open(path, 'rb') if path.is_file() else None
+
+
+# replace the sysroot `out` with the snapshot `name` from `src` in one
+# streaming pass, its files are linked from the store like extracted ones.
+def _import_snapshot(out, store, src, name):
+    if (file := _open_snapshot(src, name)) is None:
+        logger.info(f'snapshot not found: {name}')
+        return False
+
+    tmp = out.with_name(f'.{out.name}.import')
+    shutil.rmtree(tmp, ignore_errors=True)
+    with (
+        file as f,
+        compress.reader(f, 'xz') as z,
+        store.lock(),
+        tarfile.open(fileobj=z, mode='r|') as tar,
+    ):
+        _untar(tar, tmp, store, tarfile.tar_filter)
+
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+    logger.info(f'✓ 导入快照 {name}')
+    return True
+
+
+def _export_snapshot(out, dest, name):
+    dest.mkdir(parents=True, exist_ok=True)
+    tmp = dest/f'.{name}.part'
+    with (
+        open(tmp, 'wb') as f,
+        compress.writer(f, 'xz') as z,
+        tarfile.open(fileobj=z, mode='w', format=tarfile.GNU_FORMAT) as tar,
+    ):
+        tar.add(out, arcname='.')
+    os.replace(tmp, dest/name)
+    logger.info(f'✓ 导出快照 {dest/name}')
+
+
+# version and files of every installed package, kept in `.manifests` of the
+# sysroot.
+class Manifest(object):
+    def __init__(self, out):
+        self.out = out
+        self.path = out/'.manifests'
+        self.path.mkdir(exist_ok=True)
+        self.data = {
+            it.stem: json.loads(it.read_text())
+            for it in self.path.glob('*.json')
+        }
+
+    def fresh(self, pkg):
+        it = self.data.get(pkg['name'])
+        if it is None:
+            return False
+        return it['sha256'] == pkg['sha256'] and it.get('prune') == pkg['prune']
+
+    def snapshot(self, arch):
+        return _snapshot_name(arch, [
+            (k, v['sha256'], v.get('prune')) for k, v in self.data.items()])
+
+    def update(self, pkg, files):
+        self.data[pkg['name']] = {
+            'version': pkg['version'],
+            'sha256': pkg['sha256'],
+            'prune': pkg['prune'],
+            'files': files,
+        }
+        path = self.path/f'{pkg["name"]}.json'
+        path.write_text(json.dumps(self.data[pkg['name']], indent=2))
+
+    def remove(self, name):
+        del self.data[name]
+        (self.path/f'{name}.json').unlink()
+
+    # remove files of replaced or dropped versions that no installed
+    # package owns any more, then their empty directories.
+    def clean(self, before):
+        owned = set()
+        for it in self.data.values():
+            owned.update(it['files'])
+        stale = set()
+        for name, it in before.items():
+            if self.data.get(name) is not it:
+                stale.update(it['files'])
+
+        dirs = set()
+        for it in sorted(stale - owned):
+            path = self.out/it
+            path.unlink(missing_ok=True)
+            dirs.update(path.parents)
+        for it in sorted(dirs, key=lambda p: len(p.parts), reverse=True):
+            if it.is_relative_to(self.out) and it != self.out:
+                try:
+                    it.rmdir()
+                except OSError:
+                    pass
+        return len(stale - owned)
+
+
+# only packages whose deb changed since the last run are downloaded and
+# extracted, every package is extracted on the process pool as soon as it is
+# downloaded. an out of date sysroot is first restored from `snapshot` if
+# it has one for the resolved packages.
+async def _install(
+        sess, download, pool, out, arch, cache, store, depends, *src, snapshot=None):
+    loop = asyncio.get_running_loop()
+    pkgs = await _index_packages(
+        sess, cache, arch, depends, *src, timeout=download.timeout)
+
+    name = _snapshot_name(arch, [
+        (it['name'], it['sha256'], it['prune']) for it in pkgs])
+    if snapshot and Manifest(out).snapshot(arch) != name:
+        await asyncio.to_thread(_import_snapshot, out, store, snapshot, name)
+
+    manifest = Manifest(out)
+    before = dict(manifest.data)
+
+    async def install(pkg):
+        if manifest.fresh(pkg):
+            return pkg
+        pkg = await download(cache, pkg)
+        files = await loop.run_in_executor(
+            pool, _extract, out, store, pkg['path'], pkg['prune'])
+        manifest.update(pkg, files)
+        if old := before.get(pkg['name']):
+            logger.info(f'✓ 成功更新 {arch} {pkg["name"]} {old["version"]} -> {pkg["version"]}')
+        else:
+            logger.info(f'✓ 成功安装 {arch} {pkg["name"]} {pkg["version"]}')
+        return pkg
 
+    pkgs = await _spawn([install(it) for it in pkgs])
 
-def _extract(out, deb):
-    subprocess.run(['dpkg', '-x', str(deb), str(out)], check=True, stderr=True)
-    logger.info(f'✓ 成功安装 {deb.name}')
+    names = {it['name'] for it in pkgs}
+    for name in sorted(before.keys() - names):
+        manifest.remove(name)
+        logger.info(f'✓ 成功卸载 {arch} {name} {before[name]["version"]}')
+    stale = manifest.clean(before)
 
+    changed = sum(manifest.data[it] is not before.get(it) for it in names)
+    logger.info(
+        f'sysroot {arch}: {changed} changed, {len(names) - changed} unchanged, '
+        f'{len(before.keys() - names)} removed, {stale} stale files')
 
-async def _work(out, arch, *src):
-    with tempfile.TemporaryDirectory() as tmp:
-        for deb in await _download_packages(tmp, arch, *src):
-            _extract(out, deb)
+    names = sorted(f'{it["name"]} {it["version"]} {it["sha256"]}' for it in pkgs)
+    (out/'.packages').write_text('\n'.join(names))
 
     usr = out/'usr'
     dst = 'data/data/com.termux/files/usr'
@@ -104,13 +599,63 @@ async def _work(out, arch, *src):
             raise
 
     pthread = out/'usr/lib/libpthread.a'
-    pthread.write_bytes(b'INPUT(-lc)')
+    if not pthread.is_file() or pthread.read_bytes() != b'INPUT(-lc)':
+        # may be linked from the store by a package.
+        pthread.unlink(missing_ok=True)
+        pthread.write_bytes(b'INPUT(-lc)')
+
+
+# sysroots of all arches share one event loop, one session whose pooled
+# connections are kept alive between them, the downloader and the extractors.
+async def _work(targets, cache, store, depends, *src, snapshot=None, jobs=8, **kwargs):
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=jobs,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector) as sess:
+        download = Downloader(sess, jobs, **kwargs)
+        # forking this process would copy the locks of its threads
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context('forkserver')) as pool:
+            try:
+                await _spawn([
+                    _install(
+                        sess, download, pool, out, arch, cache, store,
+                        depends, *src, snapshot=snapshot)
+                    for out, arch in targets
+                ])
+            finally:
+                download.report()
+    cache.evict()
+
+    count, size = store.gc()
+    if count:
+        logger.debug(f'gc {count} objects, {size / (1 << 20):.1f} MiB')
 
 
 @utils.record
 class Sysroot:
-    def __init__(self, path: str, **kwargs):
+    def __init__(
+        self,
+        path: str,
+        cache: str = None,
+        cache_size: int = None,
+        depends: bool = False,
+        prune: bool = False,
+        jobs: int = 8,
+        retries: int = 5,
+        timeout: int = 60,
+        snapshot: str = None,
+        **kwargs,
+    ):
         self.path = pathlib.Path(path).expanduser().resolve()
+        self.cache = cache
+        self.depends = depends
+        self.prune = prune
+        self.snapshot = snapshot
+        self.download = {'jobs': jobs, 'retries': retries, 'timeout': timeout}
+        # MiB
+        self.cache_size = None if cache_size is None else cache_size << 20
         self.data = {}
 
         if not self.path.exists():
@@ -121,18 +666,56 @@ class Sysroot:
             if isinstance(v, dict):
                 self.__include__(k, **v)
 
-    def __include__(self, name, repo, dist, pkgs):
+    def __include__(self, name, repo, dist, pkgs, include=None, exclude=None):
         assert name and repo and dist and pkgs
 
-        self.data[name] = {'repo': repo, 'dist': dist, 'pkgs': pkgs}
+        prune = None
+        if self.prune or include or exclude:
+            prune = {
+                'include': include or (PRUNE_INCLUDE if self.prune else ['*']),
+                'exclude': exclude or [],
+            }
+        self.data[name] = {'repo': repo, 'dist': dist, 'pkgs': pkgs, 'prune': prune}
 
-    def __call__(self, arch: str):
-        arch = utils.termux_arch(arch)
+    def target(self, arch: str):
+        return self.path/utils.termux_arch(arch)
 
-        if self.data:
-            asyncio.run(_work(self.path, arch, *self.data.values()))
-        else:
+    def manifest(self, arch: str):
+        return self.target(arch)/'.packages'
+
+    def __call__(self, *arch: str):
+        if not self.data or not arch:
             logger.info('no work to do.')
+            return
+
+        targets = []
+        for it in dict.fromkeys(arch):
+            out = self.target(it)
+            out.mkdir(exist_ok=True)
+            targets.append((out, utils.termux_arch(it)))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = Cache(self.cache or tmp, self.cache_size)
+            asyncio.run(_work(
+                targets, cache, Store(self.path/'.objects'),
+                self.depends, *self.data.values(),
+                snapshot=self.snapshot, **self.download))
+
+    # write the up to date sysroot of `arch` as a snapshot into `dest`, which
+    # defaults to the local `snapshot` directory.
+    def export(self, arch: str, dest: str = None):
+        dest = dest or self.snapshot
+        assert dest and '://' not in dest, f'bad snapshot directory: "{dest}"'
+
+        self(arch)
+        out = self.target(arch)
+        name = Manifest(out).snapshot(utils.termux_arch(arch))
+        dest = pathlib.Path(dest).expanduser().resolve()
+        if (dest/name).is_file():
+            logger.info(f'{name} is up to date, skip.')
+            return dest/name
+        _export_snapshot(out, dest, name)
+        return dest/name
 
     def __str__(self):
         return str(self.path)
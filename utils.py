@@ -1,7 +1,10 @@
 import os
+import re
 import sys
 import git
+import types
 import inspect
+import importlib.machinery
 from loguru import logger
 from functools import wraps
 
@@ -49,6 +52,54 @@ def engine_version(root: str):
         return f.read()
 
 
+def _gn_value(value: str):
+    # drop whitespace and trailing commas of lists outside of string literals
+    value = ''.join(re.findall(r'"(?:\\.|[^"\\])*"|[^\s"]+', value))
+    return re.sub(r',(?=\])', '', value)
+
+
+def _gn_literal(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, tuple)):
+        return f'[{", ".join(_gn_literal(it) for it in value)}]'
+    if isinstance(value, str):
+        return f'"{value}"'
+    return str(value)
+
+
+# `key=value` strings or the lines of an args.gn -> {key: value}
+def parse_gn_args(lines):
+    args = {}
+    key = None
+    for line in lines:
+        line = line.split('#', 1)[0] if '"' not in line else line
+        if not line.strip():
+            continue
+        if key and args[key].count('[') > args[key].count(']'):
+            args[key] += line
+            continue
+        key, _, value = line.partition('=')
+        key = key.strip()
+        args[key] = value
+    return {k: _gn_value(v) for k, v in args.items()}
+
+
+# the gn args that engine/src/flutter/tools/gn would generate for `argv`.
+def flutter_gn_args(root: str, argv: list):
+    path = os.path.join(root, 'engine/src/flutter/tools/gn')
+    loader = importlib.machinery.SourceFileLoader('flutter_gn', path)
+    gn = types.ModuleType(loader.name)
+    gn.__file__ = path
+    loader.exec_module(gn)
+
+    args = gn.parse_args([path, *argv])
+    return parse_gn_args([
+        *(f'{k}={_gn_literal(v)}' for k, v in gn.to_gn_args(args).items()),
+        *(args.gn_args or []),
+    ])
+
+
 def recordm(func):
     @wraps(func)
     def wrapper(*args, **kwargs):